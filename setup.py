@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
+import json
 from pathlib import Path
 
 import setuptools
 from setuptools import setup
+from setuptools.command.build_py import build_py
 
 this_dir = Path(__file__).parent
 
@@ -22,6 +24,41 @@ data_files.append(version_path)
 version = version_path.read_text(encoding="utf-8").strip()
 
 
+class BuildPyWithManifest(build_py):
+    """Writes a manifest of models into the built package.
+
+    Lets the server skip scanning the data directory at startup.
+    Source checkouts and editable installs have no manifest and scan instead.
+    """
+
+    def run(self):
+        super().run()
+
+        if self.dry_run or getattr(self, "editable_mode", False):
+            return
+
+        manifest = {
+            "lib": {
+                lib_path.stem.split("_")[-1]: lib_path.relative_to(data_dir).as_posix()
+                for lib_path in sorted((data_dir / "lib" / "common").glob("*.pv"))
+            },
+            "keywords": [
+                {
+                    "name": kw_path.stem.rsplit("_", maxsplit=1)[0],
+                    "language": kw_path.parent.parent.name,
+                    "system": kw_path.stem.split("_")[-1],
+                    "path": kw_path.relative_to(data_dir).as_posix(),
+                }
+                for kw_path in sorted(data_dir.rglob("*.ppn"))
+            ],
+        }
+
+        manifest_path = Path(self.build_lib) / module_name / "data" / "keywords.json"
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(manifest, manifest_file, ensure_ascii=False, indent=2)
+
+
 # -----------------------------------------------------------------------------
 
 setup(
@@ -47,6 +84,7 @@ setup(
         "Programming Language :: Python :: 3.11",
     ],
     keywords="rhasspy wyoming porcupine wake word",
+    cmdclass={"build_py": BuildPyWithManifest},
     entry_points={
         "console_scripts": ["wyoming-porcupine1 = wyoming_porcupine1.__main__:run"]
     },
@@ -0,0 +1,290 @@
+"""Tests for the event handler and detector cache using a fake porcupine"""
+import argparse
+import array
+import asyncio
+import threading
+from typing import List, Optional, Tuple
+
+import pytest
+from wyoming.audio import AudioChunk, AudioStart, AudioStop
+from wyoming.event import Event
+from wyoming.info import Info
+from wyoming.wake import Detect
+
+from wyoming_porcupine1.__main__ import Detector, Keyword, Porcupine1EventHandler, State
+
+_KEYWORD = "porcupine"
+_SENSITIVITY = 0.5
+
+
+class FakePorcupine:
+    """Stand-in for pvporcupine.Porcupine."""
+
+    frame_length = 512
+
+    def __init__(self, detect_frame: Optional[int] = None) -> None:
+        self.detect_frame = detect_frame
+        self.frames: List[List[int]] = []
+        self.deleted = False
+
+    def process(self, pcm) -> int:
+        assert not self.deleted, "Processing with deleted porcupine"
+        assert len(pcm) == self.frame_length
+
+        self.frames.append(list(pcm))
+        if len(self.frames) == self.detect_frame:
+            return 0
+
+        return -1
+
+    def delete(self) -> None:
+        assert not self.deleted, "Porcupine deleted twice"
+        self.deleted = True
+
+
+class BlockingPorcupine(FakePorcupine):
+    """Fake porcupine that blocks in process() until released."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def process(self, pcm) -> int:
+        self.started.set()
+        self.released.wait(timeout=5)
+        return super().process(pcm)
+
+
+def make_state(max_cached_detectors: int = 5) -> State:
+    return State(
+        pv_lib_paths={"en": "params_en.pv"},
+        keywords={_KEYWORD: Keyword(language="en", name=_KEYWORD, model_path="kw.ppn")},
+        max_cached_detectors=max_cached_detectors,
+    )
+
+
+def make_handler(state: State) -> Porcupine1EventHandler:
+    handler = Porcupine1EventHandler(
+        Info().event(),
+        argparse.Namespace(sensitivity=_SENSITIVITY),
+        state,
+        None,
+        None,
+    )
+    handler.written_events = []  # type: ignore[attr-defined]
+
+    async def write_event(event: Event) -> None:
+        handler.written_events.append(event)  # type: ignore[attr-defined]
+
+    handler.write_event = write_event  # type: ignore[method-assign]
+
+    return handler
+
+
+def make_handler_with_detector(
+    detect_frame: Optional[int] = None, max_cached_detectors: int = 5
+) -> Tuple[State, FakePorcupine, Porcupine1EventHandler]:
+    """Creates a handler that gets a fake porcupine from the pool."""
+    state = make_state(max_cached_detectors=max_cached_detectors)
+    porcupine = FakePorcupine(detect_frame=detect_frame)
+    state.return_porcupine(_KEYWORD, Detector(porcupine, _SENSITIVITY))
+
+    return state, porcupine, make_handler(state)
+
+
+# -----------------------------------------------------------------------------
+
+
+@pytest.mark.asyncio
+async def test_failed_keyword_load_keeps_detector() -> None:
+    state, porcupine, handler = make_handler_with_detector(max_cached_detectors=1)
+    await handler.handle_event(Detect(names=[_KEYWORD]).event())
+    assert handler.detector is not None
+    assert handler.detector.porcupine is porcupine
+
+    # Unknown keyword fails without giving up the current detector
+    with pytest.raises(ValueError):
+        await handler.handle_event(Detect(names=["no-such-keyword"]).event())
+
+    assert handler.detector.porcupine is porcupine
+
+    # Detector is returned exactly once
+    await handler.disconnect()
+    assert not porcupine.deleted
+
+    pool = state.detector_pool[(_KEYWORD, _SENSITIVITY)]
+    assert pool.qsize() == 1
+    assert (await state.get_porcupine(_KEYWORD, _SENSITIVITY)).porcupine is porcupine
+
+
+def make_samples(num_samples: int) -> List[int]:
+    return [((i * 7919) % 65536) - 32768 for i in range(num_samples)]
+
+
+async def send_audio(
+    handler: Porcupine1EventHandler,
+    audio: bytes,
+    chunk_sizes: List[int],
+    channels: int = 1,
+    rate: int = 16000,
+) -> None:
+    await handler.handle_event(
+        AudioStart(rate=rate, width=2, channels=channels).event()
+    )
+
+    offset = 0
+    chunk_idx = 0
+    while offset < len(audio):
+        chunk_size = chunk_sizes[chunk_idx % len(chunk_sizes)]
+        await handler.handle_event(
+            AudioChunk(
+                rate=rate,
+                width=2,
+                channels=channels,
+                audio=audio[offset : offset + chunk_size],
+            ).event()
+        )
+        offset += chunk_size
+        chunk_idx += 1
+
+    await handler.handle_event(AudioStop().event())
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk_sizes", [[2, 1022, 1026, 3000], [1024], [3000]])
+async def test_frames_match_audio(chunk_sizes: List[int]) -> None:
+    _, porcupine, handler = make_handler_with_detector()
+
+    samples = make_samples(20000)
+    await send_audio(handler, array.array("h", samples).tobytes(), chunk_sizes)
+
+    # Every complete frame is processed in order
+    num_frames = len(samples) // FakePorcupine.frame_length
+    assert len(porcupine.frames) == num_frames
+    assert [s for frame in porcupine.frames for s in frame] == samples[
+        : num_frames * FakePorcupine.frame_length
+    ]
+    assert [e.type for e in handler.written_events] == ["not-detected"]
+
+
+@pytest.mark.asyncio
+async def test_converted_frames_match_audio() -> None:
+    _, porcupine, handler = make_handler_with_detector()
+
+    # Stereo with silent right channel converts to the left channel
+    samples = make_samples(5000)
+    stereo = array.array("h", [s for sample in samples for s in (sample, 0)])
+    await send_audio(handler, stereo.tobytes(), [4, 2044, 2052, 6000], channels=2)
+
+    num_frames = len(samples) // FakePorcupine.frame_length
+    assert [s for frame in porcupine.frames for s in frame] == samples[
+        : num_frames * FakePorcupine.frame_length
+    ]
+
+
+@pytest.mark.asyncio
+async def test_resampling_restarts_with_each_stream() -> None:
+    _, porcupine, handler = make_handler_with_detector()
+
+    # Same 22.05 kHz audio twice through one handler
+    audio = array.array("h", make_samples(7001)).tobytes()
+    await send_audio(handler, audio, [4410], rate=22050)
+    num_frames = len(porcupine.frames)
+    assert num_frames > 0
+
+    await send_audio(handler, audio, [4410], rate=22050)
+    assert porcupine.frames[num_frames:] == porcupine.frames[:num_frames]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("detect_frame", [1, 2, 4])
+async def test_detection_stops_processing(detect_frame: int) -> None:
+    _, porcupine, handler = make_handler_with_detector(detect_frame=detect_frame)
+
+    # 3000 byte chunks give batches of 2-3 frames
+    samples = make_samples(20000)
+    await send_audio(handler, array.array("h", samples).tobytes(), [3000])
+
+    # No frames are processed after the detection, and no not-detected is sent
+    assert len(porcupine.frames) == detect_frame
+    assert [e.type for e in handler.written_events] == ["detection"]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_batch_keeps_detector_until_done() -> None:
+    state = make_state()
+    porcupine = BlockingPorcupine()
+    state.return_porcupine(_KEYWORD, Detector(porcupine, _SENSITIVITY))
+    handler = make_handler(state)
+    loop = asyncio.get_running_loop()
+
+    # Two frames are processed in the executor
+    task = asyncio.create_task(
+        handler.handle_event(
+            AudioChunk(rate=16000, width=2, channels=1, audio=bytes(2048)).event()
+        )
+    )
+    assert await loop.run_in_executor(None, porcupine.started.wait, 5)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    # Detector isn't returned to the pool while the batch is still running
+    disconnect_task = asyncio.create_task(handler.disconnect())
+    await asyncio.sleep(0.1)
+    pool = state.detector_pool[(_KEYWORD, _SENSITIVITY)]
+    assert not disconnect_task.done()
+    assert pool.empty()
+
+    porcupine.released.set()
+    await disconnect_task
+    assert len(porcupine.frames) == 2
+    assert pool.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_is_lifo() -> None:
+    state = make_state()
+    porcupines = [FakePorcupine() for _ in range(3)]
+    for porcupine in porcupines:
+        state.return_porcupine(_KEYWORD, Detector(porcupine, _SENSITIVITY))
+
+    # Most recently returned detector comes out first
+    for porcupine in reversed(porcupines):
+        detector = await state.get_porcupine(_KEYWORD, _SENSITIVITY)
+        assert detector.porcupine is porcupine
+
+
+@pytest.mark.asyncio
+async def test_pool_is_keyed_by_sensitivity() -> None:
+    state = make_state()
+    porcupine = FakePorcupine()
+    state.return_porcupine(_KEYWORD, Detector(porcupine, 0.1 + 0.2))
+
+    pool = state.detector_pool[(_KEYWORD, 0.3)]
+    assert pool.qsize() == 1
+    assert state.detector_pool[(_KEYWORD, _SENSITIVITY)].empty()
+    assert (await state.get_porcupine(_KEYWORD, 0.3)).porcupine is porcupine
+
+
+@pytest.mark.asyncio
+async def test_full_pool_deletes_detector() -> None:
+    state = make_state(max_cached_detectors=2)
+    porcupines = [FakePorcupine() for _ in range(3)]
+    for porcupine in porcupines:
+        state.return_porcupine(_KEYWORD, Detector(porcupine, _SENSITIVITY))
+
+    assert [p.deleted for p in porcupines] == [False, False, True]
+    assert state.detector_pool[(_KEYWORD, _SENSITIVITY)].qsize() == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_cached_detectors", [0, -1])
+async def test_no_pool_deletes_detector(max_cached_detectors: int) -> None:
+    state = make_state(max_cached_detectors=max_cached_detectors)
+    porcupine = FakePorcupine()
+    state.return_porcupine(_KEYWORD, Detector(porcupine, _SENSITIVITY))
+
+    assert porcupine.deleted
+    assert (_KEYWORD, _SENSITIVITY) not in state.detector_pool
@@ -4,10 +4,11 @@ import sys
 import wave
 from asyncio.subprocess import PIPE
 from pathlib import Path
+from typing import List
 
 import pytest
 from wyoming.audio import AudioStart, AudioStop, wav_to_chunks
-from wyoming.event import async_read_event, async_write_event
+from wyoming.event import Event, async_read_event, async_write_event
 from wyoming.info import Describe, Info
 from wyoming.wake import Detect, Detection, NotDetected
 
@@ -15,9 +16,8 @@ _DIR = Path(__file__).parent
 _SAMPLES_PER_CHUNK = 1024
 
 
-@pytest.mark.asyncio
-async def test_porcupine1() -> None:
-    proc = await asyncio.create_subprocess_exec(
+async def _start_server() -> asyncio.subprocess.Process:
+    return await asyncio.create_subprocess_exec(
         sys.executable,
         "-m",
         "wyoming_porcupine1",
@@ -26,79 +26,69 @@ async def test_porcupine1() -> None:
         stdin=PIPE,
         stdout=PIPE,
     )
-    assert proc.stdin is not None
-    assert proc.stdout is not None
 
-    # Check info
-    await async_write_event(Describe().event(), proc.stdin)
-    while True:
-        event = await asyncio.wait_for(async_read_event(proc.stdout), timeout=1)
-        assert event is not None
-
-        if not Info.is_type(event.type):
-            continue
 
-        info = Info.from_event(event)
-        assert len(info.wake) == 1, "Expected one wake service"
-        wake = info.wake[0]
-        assert len(wake.models) > 0, "Expected at least one model"
-        porcupine_model = next((m for m in wake.models if m.name == "porcupine"), None)
-        assert porcupine_model is not None, "Expected porcupine model"
-        assert porcupine_model.phrase == "porcupine"
-        break
+async def _detect_wav(wav_path: Path) -> List[Event]:
+    """Stream WAV file to a new server, returning all events until it exits."""
+    proc = await _start_server()
+    assert proc.stdin is not None
+    assert proc.stdout is not None
 
     # We want to use the porcupine model
     await async_write_event(Detect(names=["porcupine"]).event(), proc.stdin)
 
-    # Test positive WAV
-    with wave.open(str(_DIR / "porcupine.wav"), "rb") as porcupine_wav:
+    with wave.open(str(wav_path), "rb") as wav_file:
         await async_write_event(
             AudioStart(
-                rate=porcupine_wav.getframerate(),
-                width=porcupine_wav.getsampwidth(),
-                channels=porcupine_wav.getnchannels(),
+                rate=wav_file.getframerate(),
+                width=wav_file.getsampwidth(),
+                channels=wav_file.getnchannels(),
             ).event(),
             proc.stdin,
         )
-        for chunk in wav_to_chunks(porcupine_wav, _SAMPLES_PER_CHUNK):
+        for chunk in wav_to_chunks(wav_file, _SAMPLES_PER_CHUNK):
             await async_write_event(chunk.event(), proc.stdin)
 
         await async_write_event(AudioStop().event(), proc.stdin)
 
+    # Server closes the connection after audio-stop
+    events: List[Event] = []
     while True:
         event = await asyncio.wait_for(async_read_event(proc.stdout), timeout=1)
-        assert event is not None
+        if event is None:
+            break
 
-        if not Detection.is_type(event.type):
-            continue
+        events.append(event)
 
-        detection = Detection.from_event(event)
-        assert detection.name == "porcupine"  # success
-        break
+    proc.stdin.close()
+    await proc.communicate()
+    assert proc.returncode == 0
 
-    # Test negative WAV
-    with wave.open(str(_DIR / "snowboy.wav"), "rb") as snowboy_wav:
-        await async_write_event(
-            AudioStart(
-                rate=snowboy_wav.getframerate(),
-                width=snowboy_wav.getsampwidth(),
-                channels=snowboy_wav.getnchannels(),
-            ).event(),
-            proc.stdin,
-        )
-        for chunk in wav_to_chunks(snowboy_wav, _SAMPLES_PER_CHUNK):
-            await async_write_event(chunk.event(), proc.stdin)
+    return events
 
-        await async_write_event(AudioStop().event(), proc.stdin)
 
+@pytest.mark.asyncio
+async def test_porcupine1() -> None:
+    proc = await _start_server()
+    assert proc.stdin is not None
+    assert proc.stdout is not None
+
+    # Check info
+    await async_write_event(Describe().event(), proc.stdin)
     while True:
         event = await asyncio.wait_for(async_read_event(proc.stdout), timeout=1)
         assert event is not None
 
-        if not NotDetected.is_type(event.type):
+        if not Info.is_type(event.type):
             continue
 
-        # Should receive a not-detected message after audio-stop
+        info = Info.from_event(event)
+        assert len(info.wake) == 1, "Expected one wake service"
+        wake = info.wake[0]
+        assert len(wake.models) > 0, "Expected at least one model"
+        porcupine_model = next((m for m in wake.models if m.name == "porcupine"), None)
+        assert porcupine_model is not None, "Expected porcupine model"
+        assert porcupine_model.phrase == "porcupine"
         break
 
     # Need to close stdin for graceful termination
@@ -106,3 +96,18 @@ async def test_porcupine1() -> None:
     await proc.communicate()
 
     assert proc.returncode == 0
+
+    # Test positive WAV
+    events = await _detect_wav(_DIR / "porcupine.wav")
+    detections = [Detection.from_event(e) for e in events if Detection.is_type(e.type)]
+    assert [d.name for d in detections] == ["porcupine"]  # success
+    assert not any(
+        NotDetected.is_type(e.type) for e in events
+    ), "Unexpected not-detected after detection"
+
+    # Test negative WAV
+    events = await _detect_wav(_DIR / "snowboy.wav")
+    assert not any(Detection.is_type(e.type) for e in events)
+
+    # Should receive a not-detected message after audio-stop
+    assert any(NotDetected.is_type(e.type) for e in events)
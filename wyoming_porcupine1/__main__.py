@@ -1,17 +1,16 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import json
 import logging
 import platform
-import struct
 import time
 from collections import defaultdict
 from dataclasses import dataclass
 from functools import partial
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, Optional, Tuple, Union
 
-import pvporcupine
 from wyoming.audio import AudioChunk, AudioChunkConverter, AudioStart, AudioStop
 from wyoming.event import Event
 from wyoming.info import Attribution, Describe, Info, WakeModel, WakeProgram
@@ -20,70 +19,113 @@ from wyoming.wake import Detect, Detection, NotDetected
 
 from . import __version__
 
+if TYPE_CHECKING:
+    # Loaded on first use since it loads a native library
+    import pvporcupine
+
 _LOGGER = logging.getLogger()
 _DIR = Path(__file__).parent
 
 DEFAULT_KEYWORD = "porcupine"
 
+# Audio format expected by porcupine
+RATE = 16000
+WIDTH = 2
+CHANNELS = 1
+
 
 @dataclass
 class Keyword:
     """Single porcupine keyword"""
 
+    __slots__ = ("language", "name", "model_path")
+
     language: str
     name: str
-    model_path: Path
+    model_path: str
 
 
 @dataclass
 class Detector:
-    porcupine: pvporcupine.Porcupine
+    __slots__ = ("porcupine", "sensitivity")
+
+    porcupine: "pvporcupine.Porcupine"
     sensitivity: float
 
 
 class State:
     """State of system"""
 
-    def __init__(self, pv_lib_paths: Dict[str, Path], keywords: Dict[str, Keyword]):
+    def __init__(
+        self,
+        pv_lib_paths: Dict[str, str],
+        keywords: Dict[str, Keyword],
+        max_cached_detectors: int,
+    ):
         self.pv_lib_paths = pv_lib_paths
         self.keywords = keywords
+        self.max_cached_detectors = max_cached_detectors
 
-        # keyword name -> [detector]
-        self.detector_cache: Dict[str, List[Detector]] = defaultdict(list)
-        self.detector_lock = asyncio.Lock()
+        # (keyword name, sensitivity) -> pool of unused detectors
+        self.detector_pool: "Dict[Tuple[str, float], asyncio.LifoQueue[Detector]]" = (
+            defaultdict(partial(asyncio.LifoQueue, maxsize=max_cached_detectors))
+        )
 
     async def get_porcupine(self, keyword_name: str, sensitivity: float) -> Detector:
         keyword = self.keywords.get(keyword_name)
         if keyword is None:
             raise ValueError(f"No keyword {keyword_name}")
 
-        # Check cache first for matching detector
-        async with self.detector_lock:
-            detectors = self.detector_cache.get(keyword_name)
-            if detectors:
-                detector = next(
-                    (d for d in detectors if d.sensitivity == sensitivity), None
+        # Check pool first for matching detector
+        detectors = self.detector_pool.get((keyword_name, round(sensitivity, 3)))
+        if detectors is not None:
+            try:
+                detector = detectors.get_nowait()
+                _LOGGER.debug(
+                    "Using detector for %s from cache (%s)",
+                    keyword_name,
+                    detectors.qsize(),
                 )
-                if detector is not None:
-                    # Remove from cache for use
-                    detectors.remove(detector)
-
-                    _LOGGER.debug(
-                        "Using detector for %s from cache (%s)",
-                        keyword_name,
-                        len(detectors),
-                    )
-                    return detector
+                return detector
+            except asyncio.QueueEmpty:
+                pass
 
+        # Load off the event loop
         _LOGGER.debug("Loading %s for %s", keyword.name, keyword.language)
-        porcupine = pvporcupine.create(
-            model_path=str(self.pv_lib_paths[keyword.language]),
-            keyword_paths=[str(keyword.model_path)],
-            sensitivities=[sensitivity],
+        import pvporcupine  # pylint: disable=redefined-outer-name
+
+        porcupine = await asyncio.get_running_loop().run_in_executor(
+            None,
+            partial(
+                pvporcupine.create,
+                model_path=self.pv_lib_paths[keyword.language],
+                keyword_paths=[keyword.model_path],
+                sensitivities=[sensitivity],
+            ),
         )
 
         return Detector(porcupine, sensitivity)
 
+    def return_porcupine(self, keyword_name: str, detector: Detector) -> None:
+        if self.max_cached_detectors > 0:
+            detectors = self.detector_pool[
+                (keyword_name, round(detector.sensitivity, 3))
+            ]
+            try:
+                detectors.put_nowait(detector)
+                _LOGGER.debug(
+                    "Detector for %s returned to cache (%s)",
+                    keyword_name,
+                    detectors.qsize(),
+                )
+                return
+            except asyncio.QueueFull:
+                pass
+
+        # Pool is full or disabled
+        detector.porcupine.delete()
+        _LOGGER.debug("Detector for %s deleted", keyword_name)
+
 
 async def main() -> None:
     """Main entry point."""
@@ -94,6 +136,18 @@ async def main() -> None:
     )
     parser.add_argument("--system", help="linux or raspberry-pi")
     parser.add_argument("--sensitivity", type=float, default=0.5)
+    parser.add_argument(
+        "--preload-keyword",
+        action="append",
+        default=[],
+        help="Keyword to load at startup (default: porcupine if available)",
+    )
+    parser.add_argument(
+        "--max-cached-detectors",
+        type=int,
+        default=5,
+        help="Maximum number of unused detectors to keep per keyword/sensitivity",
+    )
     #
     parser.add_argument("--debug", action="store_true", help="Log DEBUG messages")
     parser.add_argument(
@@ -120,22 +174,47 @@ async def main() -> None:
 
     args.data_dir = Path(args.data_dir)
 
-    # lang -> path
-    pv_lib_paths: Dict[str, Path] = {}
-    for lib_path in (args.data_dir / "lib" / "common").glob("*.pv"):
-        lib_lang = lib_path.stem.split("_")[-1]
-        pv_lib_paths[lib_lang] = lib_path
+    # lang -> path (str for pvporcupine)
+    pv_lib_paths: Dict[str, str] = {}
 
     # name -> keyword
     keywords: Dict[str, Keyword] = {}
-    for kw_path in (args.data_dir / "resources").rglob("*.ppn"):
-        kw_system = kw_path.stem.split("_")[-1]
-        if kw_system != args.system:
-            continue
 
-        kw_lang = kw_path.parent.parent.name
-        kw_name = kw_path.stem.rsplit("_", maxsplit=1)[0]
-        keywords[kw_name] = Keyword(language=kw_lang, name=kw_name, model_path=kw_path)
+    manifest_path = args.data_dir / "keywords.json"
+    if manifest_path.is_file():
+        # Use manifest generated when the package was built
+        _LOGGER.debug("Loading models from %s", manifest_path)
+        with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+
+        for lib_lang, lib_path_str in manifest["lib"].items():
+            pv_lib_paths[lib_lang] = str(args.data_dir / lib_path_str)
+
+        for kw_info in manifest["keywords"]:
+            if kw_info["system"] != args.system:
+                continue
+
+            kw_name = kw_info["name"]
+            keywords[kw_name] = Keyword(
+                language=kw_info["language"],
+                name=kw_name,
+                model_path=str(args.data_dir / kw_info["path"]),
+            )
+    else:
+        for lib_path in (args.data_dir / "lib" / "common").glob("*.pv"):
+            lib_lang = lib_path.stem.split("_")[-1]
+            pv_lib_paths[lib_lang] = str(lib_path)
+
+        for kw_path in (args.data_dir / "resources").rglob("*.ppn"):
+            kw_system = kw_path.stem.split("_")[-1]
+            if kw_system != args.system:
+                continue
+
+            kw_lang = kw_path.parent.parent.name
+            kw_name = kw_path.stem.rsplit("_", maxsplit=1)[0]
+            keywords[kw_name] = Keyword(
+                language=kw_lang, name=kw_name, model_path=str(kw_path)
+            )
 
     wyoming_info = Info(
         wake=[
@@ -166,7 +245,21 @@ async def main() -> None:
         ],
     )
 
-    state = State(pv_lib_paths=pv_lib_paths, keywords=keywords)
+    state = State(
+        pv_lib_paths=pv_lib_paths,
+        keywords=keywords,
+        max_cached_detectors=args.max_cached_detectors,
+    )
+
+    # Load detectors ahead of time so first detection doesn't wait
+    preload_keywords = args.preload_keyword
+    if (not preload_keywords) and (DEFAULT_KEYWORD in keywords):
+        preload_keywords = [DEFAULT_KEYWORD]
+
+    if args.max_cached_detectors > 0:
+        for keyword_name in preload_keywords:
+            detector = await state.get_porcupine(keyword_name, args.sensitivity)
+            state.return_porcupine(keyword_name, detector)
 
     _LOGGER.info("Ready")
 
@@ -174,7 +267,9 @@ async def main() -> None:
     server = AsyncServer.from_uri(args.uri)
 
     try:
-        await server.run(partial(Porcupine1EventHandler, wyoming_info, args, state))
+        await server.run(
+            partial(Porcupine1EventHandler, wyoming_info.event(), args, state)
+        )
     except KeyboardInterrupt:
         pass
 
@@ -187,7 +282,7 @@ class Porcupine1EventHandler(AsyncEventHandler):
 
     def __init__(
         self,
-        wyoming_info: Info,
+        wyoming_info_event: Event,
         cli_args: argparse.Namespace,
         state: State,
         *args,
@@ -196,34 +291,33 @@ class Porcupine1EventHandler(AsyncEventHandler):
         super().__init__(*args, **kwargs)
 
         self.cli_args = cli_args
-        self.wyoming_info_event = wyoming_info.event()
+        self.wyoming_info_event = wyoming_info_event
         self.client_id = str(time.monotonic_ns())
         self.state = state
-        self.converter = AudioChunkConverter(rate=16000, width=2, channels=1)
-        self.audio_buffer = bytes()
+
+        # Created on first use since resampling state is per client
+        self.converter: Optional[AudioChunkConverter] = None
+
+        self.audio_buffer = bytearray()
+
         self.detected = False
 
         self.detector: Optional[Detector] = None
         self.keyword_name: str = ""
-        self.chunk_format: str = ""
         self.bytes_per_chunk: int = 0
 
+        # Batch of frames being processed by the detector in the executor
+        self.processing: "Optional[asyncio.Future[int]]" = None
+
         _LOGGER.debug("Client connected: %s", self.client_id)
 
     async def handle_event(self, event: Event) -> bool:
-        if Describe.is_type(event.type):
-            await self.write_event(self.wyoming_info_event)
-            _LOGGER.debug("Sent info to client: %s", self.client_id)
-            return True
+        # Audio chunks are by far the most common event
+        if AudioChunk.is_type(event.type):
+            if self.detected:
+                # Ignore remaining audio after detection
+                return True
 
-        if Detect.is_type(event.type):
-            detect = Detect.from_event(event)
-            if detect.names:
-                # TODO: use all names
-                await self._load_keyword(detect.names[0])
-        elif AudioStart.is_type(event.type):
-            self.detected = False
-        elif AudioChunk.is_type(event.type):
             if self.detector is None:
                 # Default keyword
                 await self._load_keyword(DEFAULT_KEYWORD)
@@ -231,26 +325,79 @@ class Porcupine1EventHandler(AsyncEventHandler):
             assert self.detector is not None
 
             chunk = AudioChunk.from_event(event)
-            chunk = self.converter.convert(chunk)
-            self.audio_buffer += chunk.audio
+            if not (
+                (chunk.rate == RATE)
+                and (chunk.width == WIDTH)
+                and (chunk.channels == CHANNELS)
+            ):
+                if self.converter is None:
+                    self.converter = AudioChunkConverter(
+                        rate=RATE, width=WIDTH, channels=CHANNELS
+                    )
 
-            while len(self.audio_buffer) >= self.bytes_per_chunk:
-                unpacked_chunk = struct.unpack_from(
-                    self.chunk_format, self.audio_buffer[: self.bytes_per_chunk]
+                chunk = self.converter.convert(chunk)
+
+            audio: Union[bytes, bytearray]
+            is_buffered = bool(self.audio_buffer)
+            if is_buffered:
+                # Complete the partial frame left by the previous chunk
+                self.audio_buffer += chunk.audio
+                audio = self.audio_buffer
+            else:
+                # Process frames directly from the chunk without copying
+                audio = chunk.audio
+
+            num_frames = len(audio) // self.bytes_per_chunk
+            if num_frames == 1:
+                keyword_index = _process_frames(
+                    self.detector.porcupine, audio, self.bytes_per_chunk
                 )
-                keyword_index = self.detector.porcupine.process(unpacked_chunk)
-                if keyword_index >= 0:
-                    _LOGGER.debug(
-                        "Detected %s from client %s", self.keyword_name, self.client_id
-                    )
-                    await self.write_event(
-                        Detection(
-                            name=self.keyword_name, timestamp=chunk.timestamp
-                        ).event()
-                    )
+            elif num_frames > 1:
+                # Process batch of frames off the event loop.
+                # Shielded so the batch is still tracked if this task is cancelled.
+                self.processing = asyncio.get_running_loop().run_in_executor(
+                    None,
+                    _process_frames,
+                    self.detector.porcupine,
+                    audio,
+                    self.bytes_per_chunk,
+                )
+                keyword_index = await asyncio.shield(self.processing)
+                self.processing = None
+            else:
+                keyword_index = -1
 
-                self.audio_buffer = self.audio_buffer[self.bytes_per_chunk :]
+            if keyword_index >= 0:
+                _LOGGER.debug(
+                    "Detected %s from client %s", self.keyword_name, self.client_id
+                )
+                self.detected = True
+                self.audio_buffer.clear()
+                await self.write_event(
+                    Detection(name=self.keyword_name, timestamp=chunk.timestamp).event()
+                )
+            elif is_buffered:
+                # Drop processed frames
+                del self.audio_buffer[: num_frames * self.bytes_per_chunk]
+            else:
+                # Keep partial frame for the next chunk
+                self.audio_buffer += memoryview(audio)[
+                    num_frames * self.bytes_per_chunk :
+                ]
+        elif Describe.is_type(event.type):
+            await self.write_event(self.wyoming_info_event)
+            _LOGGER.debug("Sent info to client: %s", self.client_id)
+        elif Detect.is_type(event.type):
+            detect = Detect.from_event(event)
+            if detect.names:
+                # TODO: use all names
+                await self._load_keyword(detect.names[0])
+        elif AudioStart.is_type(event.type):
+            self.detected = False
+            self.audio_buffer.clear()
 
+            # Don't resample a new stream with state from the previous one
+            self.converter = None
         elif AudioStop.is_type(event.type):
             # Inform client if not detections occurred
             if not self.detected:
@@ -270,26 +417,48 @@ class Porcupine1EventHandler(AsyncEventHandler):
     async def disconnect(self) -> None:
         _LOGGER.debug("Client disconnected: %s", self.client_id)
 
+        if self.processing is not None:
+            # Detector can't be reused until the executor is done with it
+            await asyncio.wait([self.processing])
+            self.processing = None
+
         if self.detector is not None:
             # Return detector to cache
-            async with self.state.detector_lock:
-                self.state.detector_cache[self.keyword_name].append(self.detector)
-                self.detector = None
-                _LOGGER.debug(
-                    "Detector for %s returned to cache (%s)",
-                    self.keyword_name,
-                    len(self.state.detector_cache[self.keyword_name]),
-                )
+            self.state.return_porcupine(self.keyword_name, self.detector)
+            self.detector = None
 
     async def _load_keyword(self, keyword_name: str):
-        self.detector = await self.state.get_porcupine(
+        # Load new detector first so the previous one is kept if this fails
+        detector = await self.state.get_porcupine(
             keyword_name, self.cli_args.sensitivity
         )
+
+        if self.detector is not None:
+            # Return previous detector to cache
+            self.state.return_porcupine(self.keyword_name, self.detector)
+
+        self.detector = detector
         self.keyword_name = keyword_name
-        self.chunk_format = "h" * self.detector.porcupine.frame_length
         self.bytes_per_chunk = self.detector.porcupine.frame_length * 2
 
 
+def _process_frames(
+    porcupine: "pvporcupine.Porcupine",
+    audio: Union[bytes, bytearray],
+    bytes_per_chunk: int,
+) -> int:
+    """Process frames until a keyword is detected, returning its index or -1."""
+    process = porcupine.process
+    audio_view = memoryview(audio)
+    for offset in range(0, len(audio) - bytes_per_chunk + 1, bytes_per_chunk):
+        # Pass frame as int16 samples without unpacking into a tuple
+        keyword_index = process(audio_view[offset : offset + bytes_per_chunk].cast("h"))
+        if keyword_index >= 0:
+            return keyword_index
+
+    return -1
+
+
 # -----------------------------------------------------------------------------
 
 